@@ -0,0 +1,158 @@
+######
+#
+# Program name: arcbench.py
+# Purpose:      Measure arcomp cold-start time for each command (-f, -w, -r, -R)
+#               Each command is run as a fresh Python process against a scratch copy of arcomp, so the results include interpreter start-up and imports.
+#               Can also run many ingests at the same time in concurrency mode, and check that each run was compared against the run saved before it
+# Author:       Stephen Fried for Handy Guy Software
+#
+#####
+
+# Import system modules
+import argparse
+import os
+import sys
+import csv
+import sqlite3
+import shutil
+import subprocess
+import tempfile
+import time
+import statistics
+from datetime import datetime
+
+# Column headings produced by 'autorunsc.exe -a * -c -h -s -v -vt'
+autorunsHeader = ['Time','Entry Location','Entry','Enabled','Category','Profile','Description','Signer','Company','Image Path','Version','Launch String',
+    'VT detection','VT permalink','MD5','SHA-1','PESHA-1','PESHA-256','SHA-256','IMP']
+
+# Commands to benchmark. Each entry is (name, arcomp command line arguments)
+benchCommands = [
+    ('ingest', ['-f', 'bench.csv']),
+    ('report', ['-f', 'bench.csv', '-w', 'bench.html,html', '-w', 'bench.json,json']),
+    ('history', ['-r']),
+    ('remove', ['-R', '00000000-000000-000000']),
+    ]
+
+# Process command line arguments
+def processCmdLineArgs():
+    argParser = argparse.ArgumentParser(description='arcomp start-up benchmark.')
+    argParser.add_argument("-n","--repeat", type=int, default=10, help="Number of times to run each command. Default is 10.")
+    argParser.add_argument("-e","--entries", type=int, default=500, help="Number of Autoruns entries in the generated input file. Default is 500.")
+    argParser.add_argument("-o","--output", help="Append the results to <output> as well as printing them.", action="store")
+    argParser.add_argument("-p","--parallel", type=int, help="Also run <parallel> ingests at the same time in concurrency mode and check each run's ADDED and REMOVED entries against the run saved before it.", action="store")
+    argParser.add_argument("-s","--sharding", help="Turn on shard mode for the -p check.", action="store_true")
+    return argParser.parse_args()
+
+# Create a scratch arcomp installation: a copy of arcomp.py, an arcomp.ini that keeps all data in the scratch directory, and a generated Autoruns file
+# database = contents of the .ini [database] section
+def setupWorkspace(workDir, entries, database = ''):
+    progDir = os.path.join(workDir, 'arcomp')
+    os.mkdir(progDir)
+    shutil.copy(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'arcomp.py'), progDir)
+
+    # arcomp builds its paths with '\', so build the .ini and data paths the same way
+    with open(progDir + '\\arcomp.ini', 'w') as f:
+        f.write('[main]\nautorunspath=\ndatapath=\n\n[email]\n\n[fields]\nrun_id = True\naction = True\nlocation = True\nentry = True\nsigner = True\n\n[database]\n' + database)
+
+    writeAutorunsFile(os.path.join(progDir, 'bench.csv'), ['entry{}'.format(i) for i in range(entries)])
+    return progDir
+
+# Write an Autoruns .csv file with one entry for each name in entryNames
+def writeAutorunsFile(fname, entryNames):
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(autorunsHeader)
+        for name in entryNames:
+            writer.writerow(['20220101-000000', 'HKLM\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Run', name, 'enabled', 'Logon', 'System-wide',
+                'Benchmark entry {}'.format(name), '(Verified) Benchmark Signer', 'Benchmark Company', 'c:\\bench\\{}.exe'.format(name), '1.0.0.0',
+                'c:\\bench\\{}.exe /start'.format(name), '', '', '', '', '', '', '', ''])
+    return None
+
+# Run one arcomp command from the scratch directory (so bench.csv resolves) and return the elapsed wall-clock time in milliseconds
+def timeCommand(progDir, args):
+    cmd = [sys.executable, os.path.join(progDir, 'arcomp.py')] + args
+    start = time.perf_counter()
+    result = subprocess.run(cmd, cwd=progDir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = (time.perf_counter() - start) * 1000
+    if result.returncode != 0:
+        sys.stderr.write('arcomp {} failed: {}\n'.format(' '.join(args), result.stderr.decode(errors='replace')))
+        exit(1)
+    return elapsed
+
+# Run <count> ingests at the same time, then check that each run's ADDED and REMOVED entries match the run saved just before it.
+# Every ingest has the same base entries plus two entries of its own, so comparing against any run but the one before it gives a different REMOVED list.
+# Returns (seconds taken, list of error messages)
+def parallelCheck(workDir, entries, count, sharding):
+    progDir = setupWorkspace(workDir, entries, 'concurrency = True\nbusytimeout = 120\nsharding = {}\n'.format(sharding))
+    baseEntries = ['entry{}'.format(i) for i in range(entries)]
+    timeCommand(progDir, benchCommands[0][1])       # Seed the database with the base entries
+
+    for i in range(count):
+        writeAutorunsFile(os.path.join(progDir, 'parallel{}.csv'.format(i)), baseEntries + ['parallel{}-a'.format(i), 'parallel{}-b'.format(i)])
+    start = time.perf_counter()
+    procs = [subprocess.Popen([sys.executable, os.path.join(progDir, 'arcomp.py'), '-f', 'parallel{}.csv'.format(i)], cwd=progDir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        for i in range(count)]
+    errors = ['ingest {} failed: {}'.format(i, proc.communicate()[1].decode(errors='replace').strip()) for i, proc in enumerate(procs) if proc.wait() != 0]
+    elapsed = time.perf_counter() - start
+
+    # Collect every run's entries. In shard mode they're spread over the main database and the shard files.
+    dbPath = progDir + '\\arcompdata.db'
+    conn = sqlite3.connect(dbPath)
+    dbFiles = [dbPath]
+    if sharding:
+        dbFiles += ['{}-{}.db'.format(dbPath[:-3], row[0]) for row in conn.execute('SELECT DISTINCT shard FROM catalog')]
+    conn.close()
+    runs = {}
+    for dbFile in dbFiles:
+        conn = sqlite3.connect(dbFile)
+        for runId, entry, action in conn.execute('SELECT run_id, entry, action FROM history'):
+            runs.setdefault(runId, {})[entry] = action
+        conn.close()
+
+    runIds = sorted(runs)
+    if len(runIds) != count + 1:
+        errors.append('expected {} runs, found {}'.format(count + 1, len(runIds)))
+    for lastRunId, runId in zip(runIds, runIds[1:]):
+        lastEntries = {entry for entry, action in runs[lastRunId].items() if action != 'REMOVED'}
+        curEntries = {entry for entry, action in runs[runId].items() if action != 'REMOVED'}
+        for action, expected in [('ADDED', curEntries - lastEntries), ('REMOVED', lastEntries - curEntries)]:
+            actual = {entry for entry, entryAction in runs[runId].items() if entryAction == action}
+            if actual != expected:
+                errors.append('run {} {} {} expected {} (last run {})'.format(runId, action, sorted(actual), sorted(expected), lastRunId))
+    return elapsed, errors
+
+##### Let's Go! #####
+if __name__ == "__main__":
+    progArgs = processCmdLineArgs()
+
+    workDir = tempfile.mkdtemp(prefix='arcbench')
+    try:
+        progDir = setupWorkspace(workDir, progArgs.entries)
+        timeCommand(progDir, benchCommands[0][1])   # Seed the database so -r and -R have history to work with
+
+        results = []
+        for name, args in benchCommands:
+            times = [timeCommand(progDir, args) for i in range(progArgs.repeat)]
+            results.append((name, min(times), statistics.median(times), max(times)))
+
+        if progArgs.parallel is not None:
+            os.mkdir(os.path.join(workDir, 'parallel'))
+            parallelTime, parallelErrors = parallelCheck(os.path.join(workDir, 'parallel'), progArgs.entries, progArgs.parallel, progArgs.sharding)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    output = 'arcomp start-up benchmark: {} python={} entries={} repeat={}\n'.format(datetime.now().isoformat(), sys.version.split()[0], progArgs.entries, progArgs.repeat)
+    output += '{:<10}{:>12}{:>12}{:>12}\n'.format('command', 'min (ms)', 'median (ms)', 'max (ms)')
+    for name, tmin, tmed, tmax in results:
+        output += '{:<10}{:>12.1f}{:>12.1f}{:>12.1f}\n'.format(name, tmin, tmed, tmax)
+    if progArgs.parallel is not None:
+        output += '{} parallel ingests (sharding={}): {:.1f}s, {} errors\n'.format(progArgs.parallel, progArgs.sharding, parallelTime, len(parallelErrors))
+        for error in parallelErrors:
+            output += '  {}\n'.format(error)
+
+    print(output)
+    if progArgs.output is not None:
+        with open(progArgs.output, 'a') as f:
+            f.write(output + '\n')
+    if progArgs.parallel is not None and len(parallelErrors) != 0:
+        exit(1)
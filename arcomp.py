@@ -8,47 +8,40 @@
 #####
 
 # Import system modules
+# Modules only needed by one subsystem (csv & json reports, email, syslog) are imported where they are used,
+#   so commands that don't need them (e.g., -r or -R) start faster.
 import configparser
-from configparser import SafeConfigParser
 import argparse
+import contextlib
 import os
-import glob
-import csv
 import sqlite3
-import json
 import sys
 from datetime import datetime
-import subprocess
-import smtplib
-import email
-import tempfile
-import ssl
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 import time
 import socket
-import logging
-from logging.handlers import SysLogHandler
 
 # Global program info. Do Not Change.
-version = ['1.0.1','Release']
+version = ['1.1.0','Release']
 gitSourceUrl = 'https://github.com/HandyGuySoftware/arcomp'
 copyright = 'Copyright (c) 2022 Stephen Fried for Handy Guy Software. Released under MIT license. See LICENSE file for details'
 
 # Global error and exit handler
 def oops(msg):
     sys.stderr.write(msg)
-    if 'db' in vars():
+    if 'db' in globals():
         db.dbRollback()
         db.dbClose()
-    if 'progLog' in vars():
+    if 'progLog' in globals():
         progLog.logClose()
     exit(1)
 
+# Check if a database error means another process has the database locked
+def isBusyError(err):
+    return isinstance(err, sqlite3.OperationalError) and ('locked' in str(err) or 'busy' in str(err))
+
 class Logger:
     logfile = None
+    logLock = None      # Set by self.enableThreading() when more than one thread writes to the log
 
     def __init__(self, fname):
         try:
@@ -60,10 +53,17 @@ class Logger:
             oops("Log file open error")
         return None
 
+    # Serialize log writes. Used by the ingest server (-l), where several threads write to the log.
+    def enableThreading(self):
+        import threading
+        self.logLock = threading.Lock()
+        return None
+
     def logWrite(self, msg):
         if self.logfile is not None:
-            self.logfile.write('[{}][run_id:{}][DEBUG] {}\n'.format(datetime.now().isoformat(), options['run_id'], msg))
-            self.logfile.flush()
+            with self.logLock or contextlib.nullcontext():
+                self.logfile.write('[{}][run_id:{}][DEBUG] {}\n'.format(datetime.now().isoformat(), options['run_id'], msg))
+                self.logfile.flush()
         return None
 
     def logClose(self):
@@ -114,11 +114,45 @@ class IniOptions:
 
 # SQLite database management class
 class Database:
-    dbConn = None   # atabase connection
-    def __init__(self, dbPath):
-        self.dbConn = sqlite3.connect(dbPath)   # Connect to database
+    dbConn = None       # Database connection
+    readOnly = False    # True if the connection was opened without write access
+    concurrency = False # True if running in concurrency mode (WAL journal, busy timeout & retry)
+    busyRetries = 0     # Number of times to retry a statement that fails because the database is locked
+    sharding = False    # True if runs are stored in monthly shard databases instead of the main history table
+    dbPath = None       # Path to the main database file. Shard files are stored next to it.
+    attachedShards = None   # Shards currently attached to this connection
+    maxAttached = 10    # SQLite's limit on the number of databases attached to a connection
+
+    # dbPath = path to the database file
+    # readOnly = open an existing database read-only so it never contends with writers for locks
+    # concurrency = enable WAL mode and busy handling so several arcomp processes can share the database
+    # busyTimeout = seconds SQLite waits on a locked database before giving up
+    # busyRetries = number of times to retry a statement after the busy timeout expires
+    # sharding = store each month's runs in its own database file (see self.historyTable())
+    def __init__(self, dbPath, readOnly = False, concurrency = False, busyTimeout = 5.0, busyRetries = 0, sharding = False):
+        self.dbPath = dbPath
+        self.readOnly = readOnly
+        self.concurrency = concurrency
+        self.busyRetries = busyRetries
+        self.sharding = sharding
+        self.attachedShards = []
+        if readOnly:
+            self.dbConn = sqlite3.connect(self.dbUri(dbPath, 'ro'), uri=True, timeout=busyTimeout)   # Connect to database (read-only)
+        else:
+            self.dbConn = sqlite3.connect(dbPath, timeout=busyTimeout)   # Connect to database
+            if concurrency:
+                # WAL lets readers keep working while a writer is active. The setting is persistent in the database file.
+                self.execSqlStmt('PRAGMA journal_mode=WAL')
         return None
 
+    # Build an SQLite URI for a database file, so it can be opened with a specific mode (e.g., 'ro' for read-only)
+    def dbUri(self, dbPath, mode):
+        import urllib.parse
+        uriPath = urllib.parse.quote(os.path.abspath(dbPath).replace(os.sep, '/'), safe='/:')
+        if not uriPath.startswith('/'):     # Windows drive letter path (C:/...)
+            uriPath = '/' + uriPath
+        return 'file://{}?mode={}'.format(uriPath, mode)
+
     def dbClose(self):
         # Don't attempt to close a non-existant conmnection
         if self.dbConn:
@@ -128,23 +162,127 @@ class Database:
 
     # Initialize database, if needed
     def dbSetup(self):
-        # Get count of tables named 'history.' If the count is not 1, then the table doesn't exist, so create it
-        curs = self.dbConn.cursor()
-        curs.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='history'")
-        
-        # (Re)build the history table. The fields here need to be named specifically, 
+        # (Re)build the history table if it doesn't exist, and add any fields missing from older databases.
+        # The fields need to be named specifically in self.createHistoryTable(),
         #   as there is no way to automatically extract field names from a table that does not yet exist (see comment in self.getTableFieldNames()
-        if curs.fetchone()[0] !=1:
-            self.execSqlStmt('CREATE TABLE "history" ( `run_id` TEXT, `action` TEXT, `keyword` TEXT, `time` TEXT, `location` TEXT, `entry` TEXT, \
-                `enabled` TEXT, `category` TEXT, `profile` TEXT, `description` TEXT, `signer` TEXT, `company` TEXT, `imagepath` TEXT, `version` TEXT, \
-                `launchstring` TEXT, `vtdetection` TEXT, `vtpermalink` TEXT, `md5` TEXT, `sha1` TEXT, `pesha1` TEXT, `pesha256` TEXT, `sha256` TEXT, `imp` TEXT)')
+        self.createHistoryTable('main')
+
+        # In shard mode the main database keeps a catalog of which shard (and host) holds each run
+        if self.sharding:
+            self.execSqlStmt('CREATE TABLE IF NOT EXISTS "catalog" ( `run_id` TEXT PRIMARY KEY, `shard` TEXT, `hostname` TEXT)')
+            if 'hostname' not in self.getTableFieldNames('catalog'):
+                self.execSqlStmt('ALTER TABLE catalog ADD COLUMN `hostname` TEXT')
         self.dbCommit()
         return None
 
+    # Create the history table in a database schema ('main' or an attached shard)
+    def createHistoryTable(self, schema):
+        self.execSqlStmt('CREATE TABLE IF NOT EXISTS {}."history" ( `run_id` TEXT, `action` TEXT, `keyword` TEXT, `time` TEXT, `location` TEXT, `entry` TEXT, \
+            `enabled` TEXT, `category` TEXT, `profile` TEXT, `description` TEXT, `signer` TEXT, `company` TEXT, `imagepath` TEXT, `version` TEXT, \
+            `launchstring` TEXT, `vtdetection` TEXT, `vtpermalink` TEXT, `md5` TEXT, `sha1` TEXT, `pesha1` TEXT, `pesha256` TEXT, `sha256` TEXT, `imp` TEXT, `hostname` TEXT)'.format(schema))
+
+        # Databases created before version 1.1.0 don't have the 'hostname' field. Add it to the end so the field order still matches new tables.
+        curs = self.execSqlStmt('PRAGMA {}.table_info(history)'.format(schema))
+        if 'hostname' not in [column[1] for column in curs.fetchall()]:
+            self.execSqlStmt('ALTER TABLE {}.history ADD COLUMN `hostname` TEXT'.format(schema))
+
+        # Every query selects by run_id, and finding a host's last run selects by hostname. Index both so they don't scan the whole history.
+        self.execSqlStmt('CREATE INDEX IF NOT EXISTS {}.history_run_id ON history (run_id)'.format(schema))
+        self.execSqlStmt('CREATE INDEX IF NOT EXISTS {}.history_hostname ON history (hostname, run_id)'.format(schema))
+        return None
+
+    # Check if a table exists in the database
+    def hasTable(self, table):
+        curs = self.execSqlStmt("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{}'".format(table))
+        return curs.fetchone()[0] == 1
+
+    # Shard support
+    # In shard mode each month's runs are stored in their own database file (arcompdata-YYYYMM.db) next to the main database.
+    # The main database keeps the catalog (run_id -> shard) and only ATTACHes the shards a command actually needs.
+    # Old shards can be archived, compressed, or deleted as whole files. Runs in a missing shard file are treated as archived.
+    # Runs stored before shard mode was turned on stay in the main history table.
+
+    # Get the shard (YYYYMM) a run_id belongs to. run_ids start with the run date (YYYYMMDD-...)
+    def shardName(self, runid):
+        return runid[0:6]
+
+    # Get the path to a shard database file
+    def shardPath(self, shard):
+        return '{}-{}.db'.format(self.dbPath[:-3], shard)
+
+    # Check if a shard's database file is still present (i.e., it hasn't been archived or removed)
+    def shardExists(self, shard):
+        return os.path.isfile(self.shardPath(shard))
+
+    # ATTACH a shard database to the connection. Return False if the shard file does not exist and create is False.
+    # SQLite can't ATTACH inside a transaction, so shards needed by a write must be attached before self.dbBeginWrite()
+    def attachShard(self, shard, create = False):
+        if shard in self.attachedShards:
+            return True
+        if not create and not self.shardExists(shard):
+            return False
+
+        progLog.logWrite("Attaching shard [{}].".format(shard))
+        if self.readOnly:
+            self.execSqlStmt("ATTACH DATABASE '{}' AS shard_{}".format(self.dbUri(self.shardPath(shard), 'ro'), shard))
+        else:
+            self.execSqlStmt("ATTACH DATABASE ? AS shard_{}".format(shard), (self.shardPath(shard),))
+            if self.concurrency:
+                self.execSqlStmt('PRAGMA shard_{}.journal_mode=WAL'.format(shard))
+            self.createHistoryTable('shard_{}'.format(shard))
+        self.attachedShards.append(shard)
+        return True
+
+    # DETACH all attached shards so a long-running connection stays under SQLite's attached database limit.
+    # SQLite can't DETACH inside a transaction, so call this after self.dbCommit() or self.dbRollback()
+    def detachShards(self):
+        for shard in self.attachedShards:
+            progLog.logWrite("Detaching shard [{}].".format(shard))
+            self.execSqlStmt('DETACH DATABASE shard_{}'.format(shard))
+        self.attachedShards = []
+        return None
+
+    # Return the name of the history table that holds a run, attaching its shard if needed.
+    # create = the run is being added to the database, so create its shard if it doesn't exist yet
+    # Returns None if the run's shard has been archived.
+    def historyTable(self, runid, create = False):
+        if not self.sharding or runid == '':
+            return 'history'
+
+        curs = self.execSqlStmt("SELECT shard FROM catalog WHERE run_id = '{}'".format(runid))
+        catalogRow = curs.fetchone()
+        if catalogRow is not None:
+            shard = catalogRow[0]
+        elif create:
+            shard = self.shardName(runid)
+        else:
+            return 'main.history'       # Not in the catalog - the run was stored before shard mode was turned on
+
+        if not self.attachShard(shard, create):
+            return None
+        return 'shard_{}.history'.format(shard)
+
+    # Add a run to the shard catalog
+    def catalogRun(self, runid, hostname):
+        if self.sharding:
+            self.execSqlStmt("INSERT OR REPLACE INTO catalog (run_id, shard, hostname) VALUES (?, ?, ?)", (runid, self.shardName(runid), hostname))
+        return None
+
+    def inTransaction(self):
+        return self.dbConn.in_transaction
+
+    # Start a write transaction.
+    # In concurrency mode the write lock is taken up front (BEGIN IMMEDIATE), so an ingest or deletion runs as one transaction
+    #   and never fails half-way through because another process started writing first.
+    def dbBeginWrite(self):
+        if self.dbConn and self.concurrency and not self.readOnly and not self.dbConn.in_transaction:
+            self.execSqlStmt('BEGIN IMMEDIATE')
+        return None
+
     # Commit pending database transactions
     def dbCommit(self):
         if self.dbConn:     # Don't try to commit to a nonexistant connection
-            self.dbConn.commit()
+            self.retryIfBusy(self.dbConn.commit)
         return None
 
     # Rollback database transactions. 
@@ -154,31 +292,65 @@ class Database:
             self.dbConn.rollback()
         return None
 
+    # Savepoints let part of a write transaction be undone without losing the rest of it.
+    # Start the transaction first if it isn't open yet. Otherwise releasing the savepoint would commit.
+    def dbSavepoint(self, name):
+        if not self.dbConn.in_transaction:
+            self.execSqlStmt('BEGIN')
+        self.execSqlStmt('SAVEPOINT {}'.format(name))
+        return None
+
+    def dbReleaseSavepoint(self, name):
+        self.execSqlStmt('RELEASE SAVEPOINT {}'.format(name))
+        return None
+
+    # Undo everything since the savepoint was set, and remove the savepoint
+    def dbRollbackToSavepoint(self, name):
+        self.execSqlStmt('ROLLBACK TO SAVEPOINT {}'.format(name))
+        self.execSqlStmt('RELEASE SAVEPOINT {}'.format(name))
+        return None
+
     # Execute a SQLite command and manage exceptions
     # Return the cursor object to the command result
     # stmt = SQL statement to execute
     # values = tuple to use if the stmt is in the form 'UPDATE table (flds,...) VALUES (?, ?, ?....)
+    # If the database is locked by another process, the statement is retried up to self.busyRetries times
     def execSqlStmt(self, stmt, values = None):
         if not self.dbConn:     # Don't execute against a non-existant db connection
             return None
-        # Set db cursor
-        if values is None:                  # Somple SQL statement
-            curs = self.dbConn.cursor()
-            curs.execute(stmt)
-        else:                               # Values-based update
-            self.dbConn.execute(stmt, values)
-            curs = None
-        return curs
+
+        def execute():
+            # Set db cursor
+            if values is None:                  # Somple SQL statement
+                curs = self.dbConn.cursor()
+                curs.execute(stmt)
+            else:                               # Values-based update
+                self.dbConn.execute(stmt, values)
+                curs = None
+            return curs
+        return self.retryIfBusy(execute)
+
+    # Call func(), retrying up to self.busyRetries times if the database is locked by another process
+    # If the database is still locked after the last retry, the sqlite3.OperationalError is raised to the caller
+    def retryIfBusy(self, func):
+        attempt = 0
+        while True:
+            try:
+                return func()
+            except sqlite3.OperationalError as err:
+                if not isBusyError(err) or attempt >= self.busyRetries:
+                    raise
+                attempt += 1
+                progLog.logWrite("Database busy ({}). Retry {} of {}.".format(err, attempt, self.busyRetries))
+                time.sleep(0.1 * attempt)   # Back off a little more on each retry
 
     # Retrieve the field names from a specific table
     # This is used so that the code does not have to be manually updated in the event the field configuration changes
-    # Except that the fields DO need to be manually updated in self.dbSetup(), as you can't extract fields from a table that doesn't exist.
+    # Except that the fields DO need to be manually updated in self.createHistoryTable(), as you can't extract fields from a table that doesn't exist.
+    # The names come from the table schema (PRAGMA table_info), so no table data needs to be read.
     def getTableFieldNames(self, table):
-        result = {}
-        db.row_factory = sqlite3.Row
-        curs = db.execSqlStmt("SELECT * FROM {}".format(table))
-        rows = curs.fetchall()
-        flds = [description[0] for description in curs.description]     # get field names
+        curs = self.execSqlStmt("PRAGMA table_info({})".format(table))
+        flds = [column[1] for column in curs.fetchall()]     # get field names (column 1 of each table_info row)
 
         return flds
 
@@ -190,76 +362,185 @@ def processCmdLineArgs():
     argParser.add_argument("-c","--content", type=str, help="Specify sections to include in the report ('a'dd, 'r'emove, or 's'ame)")
     argParser.add_argument("-e","--email", help="Send report to an email account. Make sure the [email] section of the arcomp.ini file is filled in properly.", action="store_true")
     argParser.add_argument("-f","--file", help="Specify a .csv file to load into system. Must be created using 'autorunsc.exe -a * -c -h -s -u -v -vt -o <filename>'", action="store")
+    argParser.add_argument("-l","--listen", help="Run the HTTP ingest server so endpoints can upload Autoruns files. Format is '-l <address>[:port]'. Default port is 8514", action="store")
     argParser.add_argument("-r", "--runhistory", help="Print full history of autorunsc results.", action="store_true")
     argParser.add_argument("-R", "--runremove", help="Remove a specific <run_id> from the database.", action="store")
     argParser.add_argument("-s","--syslog", help="Send output to syslog server. Format is '-s <IP address or DNS name>[:port]'. Default port is 514", action="store")
-    argParser.add_argument("-w","--write", help="Write report output to a file. Format for argument is '-w <fname>,<type>'. Valid types are 'text', 'html', 'csv', and 'json'", action="append")
+    argParser.add_argument("-w","--write", help="Write report output to a file. Format for argument is '-w <fname>,<type>'. Valid types are 'text', 'html', 'csv', 'json', and 'ndjson'", action="append")
     try:
         cmdLineArgs = argParser.parse_args()
     except:
         oops("Command line parsing exception.")
     return cmdLineArgs
 
+# Report a database error that stops a write (e.g., the database stayed locked by another arcomp process) and exit
+def dbErrorExit(err):
+    progLog.logWrite("Database error: {}".format(err))
+    if isBusyError(err):
+        oops("Database busy: another arcomp process is using the database. Try again later, or increase busytimeout or busyretries in the [database] section of arcomp.ini. ({})\n".format(err))
+    oops("Database error: {}\n".format(err))
+
+# Open the arcomp database using the options in the [database] section of the .ini file
+# readOnly = open a separate read-only connection (concurrency mode only). Falls back to a read/write connection if the database hasn't been created yet.
+def openDatabase(options, readOnly = False):
+    dbPath = options['datapath'] + '\\arcompdata.db'
+    dbOpts = options['database']
+
+    if readOnly and dbOpts['concurrency'] and os.path.isfile(dbPath):
+        progLog.logWrite("Opening read-only database connection.")
+        roDb = Database(dbPath, readOnly = True, concurrency = True, busyTimeout = dbOpts['busytimeout'], busyRetries = dbOpts['busyretries'], sharding = dbOpts['sharding'])
+        if roDb.hasTable('history') and (not dbOpts['sharding'] or roDb.hasTable('catalog')):
+            return roDb
+        roDb.dbClose()      # Database exists but was never set up. Need write access to create the history (and catalog) table.
+
+    progLog.logWrite("Opening database connection. Concurrency=[{}] Sharding=[{}]".format(dbOpts['concurrency'], dbOpts['sharding']))
+    rwDb = Database(dbPath, concurrency = dbOpts['concurrency'], busyTimeout = dbOpts['busytimeout'], busyRetries = dbOpts['busyretries'], sharding = dbOpts['sharding'])
+    rwDb.dbSetup()
+    return rwDb
+
 # Load data from AutoRuns execution and add it to the database
 def loadAutoRunData(options):
+    import csv
     progLog.logWrite('Loading Autoruns data from file {}'.format(options['file']))
                      
     # Load data lines from file, in .csv format
     with open(options['file']) as f:
-        reader = csv.reader(f)
-        for row in reader:
-            if row[0] == 'Time':  # Skip header row
-                continue
+        insertAutoRunRows(options, csv.reader(f))
+    return None
 
-            # Create the field and values list for the impending SQLite INSERT call.
-            fldlist = ''
-            vallist = ''
-            for fld in options['dbfields']:     # Run through each field in the history table
-                fldlist += '{},'.format(fld)
-                vallist += '?,'
-            fldlist = fldlist[:-1]      # Remove trailing ','
-            vallist = vallist[:-1]      # Remove trailing ','
-
-            sqlStmt = "INSERT INTO history ({}) VALUES ({})".format(fldlist,vallist)
-
-            # Create the tuple needed for the 'VALUES' section of the SQL statement
-            # The 'keyword' field in the table is a unique key, a concatenation of the 'location' and 'entry' fields
-            rowTup = (options['run_id'],'', row[1]+'-'+row[2]) + tuple(row)
-            if len(rowTup) < len(options['dbfields']): # need to pad fields
-                for j in range(len(options['dbfields']) - len(rowTup)):
-                    rowTup += ('',)
-            progLog.logWrite("Inserting new record: [{}]".format(row[1]+'-'+row[2]))
-            db.execSqlStmt(sqlStmt, rowTup)
+# Add the rows of an Autoruns execution to the database as run options['run_id'] for host options['hostname']
+# rows = iterable of Autoruns .csv rows (lists of fields). The header row is skipped.
+def insertAutoRunRows(options, rows):
+    histTable = db.historyTable(options['run_id'], create = True)   # Table to load into. In shard mode this is the current month's shard.
+    db.catalogRun(options['run_id'], options['hostname'])
+    hostIndex = options['dbfields'].index('hostname')
+
+    # Create the field and values list for the impending SQLite INSERT call.
+    fldlist = ''
+    vallist = ''
+    for fld in options['dbfields']:     # Run through each field in the history table
+        fldlist += '{},'.format(fld)
+        vallist += '?,'
+    fldlist = fldlist[:-1]      # Remove trailing ','
+    vallist = vallist[:-1]      # Remove trailing ','
+
+    sqlStmt = "INSERT INTO {} ({}) VALUES ({})".format(histTable,fldlist,vallist)
+
+    for row in rows:
+        if row[0] == 'Time':  # Skip header row
+            continue
+
+        # Create the tuple needed for the 'VALUES' section of the SQL statement
+        # The 'keyword' field in the table is a unique key, a concatenation of the 'location' and 'entry' fields
+        rowTup = (options['run_id'],'', row[1]+'-'+row[2]) + tuple(row)
+        if len(rowTup) < len(options['dbfields']): # need to pad fields
+            for j in range(len(options['dbfields']) - len(rowTup)):
+                rowTup += ('',)
+        rowTup = rowTup[:hostIndex] + (options['hostname'],) + rowTup[hostIndex+1:]
+        progLog.logWrite("Inserting new record: [{}]".format(row[1]+'-'+row[2]))
+        db.execSqlStmt(sqlStmt, rowTup)
     return None
 
-# Get the last run_id stored in the system. This is used to extract data from the last run to compare against the current run
-def getLastRunId():
-    curs = db.execSqlStmt('SELECT DISTINCT run_id FROM history ORDER BY run_id DESC LIMIT 0,1')
-    lastRunId = curs.fetchone()
-    progLog.logWrite("Retrieved last run_id: [{}]".format(lastRunId))
+# Get the last run_id stored in the system for a host. This is used to extract data from the last run to compare against the current run
+# Runs stored before version 1.1.0 have no hostname. They belong to the local machine.
+# In shard mode this attaches the shards it looks at. Inside a write transaction, where SQLite can't ATTACH, it returns None if it needs a shard that isn't attached yet.
+def getLastRunId(hostname):
+    hostFilter = "hostname = '{}'".format(hostname.replace("'", "''"))
+    if hostname == options['hostname']:
+        hostFilter = "({} OR hostname IS NULL OR hostname = '')".format(hostFilter)
+
+    if db.sharding:
+        # Use the most recent run in the catalog whose shard hasn't been archived, or a run from before shard mode was turned on
+        lastRunId = None
+        curs = db.execSqlStmt('SELECT run_id, shard FROM catalog WHERE {} ORDER BY run_id DESC'.format(hostFilter))
+        for catalogRow in curs.fetchall():
+            if db.inTransaction() and catalogRow[1] not in db.attachedShards and db.shardExists(catalogRow[1]):
+                progLog.logWrite("Last run for host [{}] may be in shard [{}], which isn't attached.".format(hostname, catalogRow[1]))
+                return None
+            histTable = db.historyTable(catalogRow[0])
+            if histTable is None:       # Archived
+                continue
+            # The catalog and shard are separate files, so a crash during a commit can leave a catalog entry with no data behind. Skip those runs.
+            if db.execSqlStmt("SELECT run_id FROM {} WHERE run_id = '{}' LIMIT 1".format(histTable, catalogRow[0])).fetchone() is None:
+                progLog.logWrite("run_id [{}] is in the catalog but has no data. Skipping.".format(catalogRow[0]))
+                continue
+            lastRunId = catalogRow
+            break
+        if lastRunId is None:
+            curs = db.execSqlStmt('SELECT DISTINCT run_id FROM main.history WHERE {} ORDER BY run_id DESC LIMIT 0,1'.format(hostFilter))
+            lastRunId = curs.fetchone()
+    else:
+        curs = db.execSqlStmt('SELECT DISTINCT run_id FROM history WHERE {} ORDER BY run_id DESC LIMIT 0,1'.format(hostFilter))
+        lastRunId = curs.fetchone()
+    progLog.logWrite("Retrieved last run_id for host [{}]: [{}]".format(hostname, lastRunId))
     if lastRunId is None:       # Empty DB - no last run_id available
         return ''
     else:
         return lastRunId[0]
 
+# Return a new run_id, based on the current time
+def newRunId():
+    return datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+
+# Start the write transaction for new runs, then give each run its run_id and find its host's last run while holding the write lock.
+# With the lock held (concurrency mode) no other process can save a run in between, so run_ids are in the order the runs are saved
+#   and each run is compared against the run saved just before it.
+# runs = list of options dictionaries, one per new run, each with a 'hostname'. Sets 'run_id' and 'last_runid' in each.
+# runIdFunc = function that returns a new run_id
+# In shard mode, the shards for the runs must be attached before the transaction starts (see attachRunShards()), because SQLite can't ATTACH inside a transaction.
+#   If another process saved a run in a shard that isn't attached, roll back, attach it, and try again.
+def beginRuns(runs, runIdFunc):
+    while True:
+        db.dbBeginWrite()
+        lastRuns = {}       # Run added for each host so far. A host's second run is compared against its first.
+        retry = False
+        for run in runs:
+            run['run_id'] = runIdFunc()
+            run['last_runid'] = lastRuns.get(run['hostname'])
+            if run['last_runid'] is None:
+                run['last_runid'] = getLastRunId(run['hostname'])
+            lastRuns[run['hostname']] = run['run_id']
+            if run['last_runid'] is None or (db.sharding and db.shardName(run['run_id']) not in db.attachedShards):
+                retry = True
+                break
+        if not retry:
+            return None
+
+        progLog.logWrite("A shard needed by the new runs isn't attached. Attaching it and trying again.")
+        db.dbRollback()
+        for run in runs:
+            attachRunShards(run['hostname'], runIdFunc())
+
+# In shard mode, attach the shards a new run for a host will use: the one for runId and the one holding the host's last run.
+# Call this before beginRuns(), since SQLite can't ATTACH inside a transaction.
+def attachRunShards(hostname, runId):
+    if db.sharding:
+        db.historyTable(runId, create = True)
+        getLastRunId(hostname)
+    return None
+
 # This is where the sausage is made. Run comparisions between the current run and last run data, looking for what's been added, removed, and left the same
 def compareAutoRunData(options):
     progLog.logWrite("Comparing Autorun data: [{}] vs [{}]".format(options['run_id'], options['last_runid']))
     lastRunId = options['last_runid']
 
+    # Tables holding the current and last runs. These are different tables if the runs are in different shards.
+    curTable = db.historyTable(options['run_id'])
+    lastTable = db.historyTable(options['last_runid'])
+
     # if last_runid == '', this is the first run. Everything gets added.
     if options['last_runid'] == '':
         progLog.logWrite("No last_runid. First time run. Everything gets added.")
-        curs = db.execSqlStmt("UPDATE history SET action='ADDED' WHERE run_id = '{}'".format(options['run_id']))
+        curs = db.execSqlStmt("UPDATE {} SET action='ADDED' WHERE run_id = '{}'".format(curTable, options['run_id']))
     else:
         progLog.logWrite("Noting ADDED entries.")
         # Get rows where an entry is in the current run but not in the last run
-        curs = db.execSqlStmt("SELECT DISTINCT keyword FROM history WHERE run_id == '{}' and keyword NOT IN (SELECT DISTINCT keyword FROM history WHERE run_id == '{}')".format(options['run_id'], options['last_runid']))
+        curs = db.execSqlStmt("SELECT DISTINCT keyword FROM {} WHERE run_id == '{}' and keyword NOT IN (SELECT DISTINCT keyword FROM {} WHERE run_id == '{}')".format(curTable, options['run_id'], lastTable, options['last_runid']))
         distinctRows = curs.fetchall()
         if len(distinctRows) != 0:
             for keyword in distinctRows:
                 # Set the action for that row to 'ADDED'
-                curs = db.execSqlStmt("UPDATE history SET action='ADDED' where run_id='{}' and keyword='{}'".format(options['run_id'],keyword[0]))
+                curs = db.execSqlStmt("UPDATE {} SET action='ADDED' where run_id='{}' and keyword='{}'".format(curTable, options['run_id'],keyword[0]))
 
     # See what was deleted since the last run (an entry is in the last run but not in the current run)
     # HOWEVER, if something was detected as deleted in the last run, a 'REMOVED' record was added to that run, creating a phantom record for an item that really wasn't found during the run.
@@ -267,17 +548,17 @@ def compareAutoRunData(options):
     if options['last_runid'] != '':             # if last_runid == '', this is the first run. There's nothing that can be deleted.
         progLog.logWrite("Noting REMOVED entries.")
         # Create a temporary table to hold the changed data, then copy that table back into the history table.
-        curs = db.execSqlStmt("CREATE TEMPORARY TABLE tmphistory AS SELECT * FROM history WHERE run_id == '{}' AND action != 'REMOVED' \
+        curs = db.execSqlStmt("CREATE TEMPORARY TABLE tmphistory AS SELECT * FROM {} WHERE run_id == '{}' AND action != 'REMOVED' \
             AND keyword NOT IN \
-                (SELECT DISTINCT keyword FROM history WHERE run_id == '{}')".format(options['last_runid'], options['run_id']))
+                (SELECT DISTINCT keyword FROM {} WHERE run_id == '{}')".format(lastTable, options['last_runid'], curTable, options['run_id']))
         curs = db.execSqlStmt("UPDATE tmphistory SET run_id='{}', action='REMOVED'".format(options['run_id']))
-        curs = db.execSqlStmt("INSERT INTO history SELECT * FROM tmphistory")
+        curs = db.execSqlStmt("INSERT INTO {} SELECT * FROM tmphistory".format(curTable))
         curs = db.execSqlStmt("DROP TABLE IF EXISTS tmphistory")
 
     # See what's the same since the last run. Basically, whatever is not tagged as 'ADDED' or 'REMOVED' is tagged as 'SAME'.
     if options['last_runid'] != '':             # if last_runid == '', this is the first run. There's nothing that's the same.
         progLog.logWrite("Noting SAME entries.")
-        curs = db.execSqlStmt("UPDATE history SET action='SAME' WHERE run_id='{}' and action IS ''".format(options['run_id']))
+        curs = db.execSqlStmt("UPDATE {} SET action='SAME' WHERE run_id='{}' and action IS ''".format(curTable, options['run_id']))
     return
 
 # Generate a dictionary from a list of fields returned form an SQL query
@@ -331,9 +612,10 @@ def generateReport(options):
         }
     
     # For each type of result, select from the history table with the current run_id and action='<whatever>'
-    rptOutput['added']['fieldnames'], rptOutput['added']['result'] = generateDictFromSql("SELECT * FROM history WHERE run_id='{}' and action='ADDED'".format(options['run_id']))
-    rptOutput['removed']['fieldnames'], rptOutput['removed']['result'] = generateDictFromSql("SELECT * FROM history WHERE run_id='{}' and action='REMOVED'".format(options['run_id']))
-    rptOutput['same']['fieldnames'], rptOutput['same']['result'] = generateDictFromSql("SELECT * FROM history WHERE run_id='{}' and action='SAME'".format(options['run_id']))
+    histTable = db.historyTable(options['run_id'])
+    rptOutput['added']['fieldnames'], rptOutput['added']['result'] = generateDictFromSql("SELECT * FROM {} WHERE run_id='{}' and action='ADDED'".format(histTable, options['run_id']))
+    rptOutput['removed']['fieldnames'], rptOutput['removed']['result'] = generateDictFromSql("SELECT * FROM {} WHERE run_id='{}' and action='REMOVED'".format(histTable, options['run_id']))
+    rptOutput['same']['fieldnames'], rptOutput['same']['result'] = generateDictFromSql("SELECT * FROM {} WHERE run_id='{}' and action='SAME'".format(histTable, options['run_id']))
     return rptOutput
 
 # Build an HTML-style output
@@ -494,9 +776,13 @@ def buildCSV(data, options):
 
 # Write the output report(s) to files, if specified on the command line
 def writeFiles(data, options):
+    import json
     progLog.logWrite("Writing reports to files.")
     for item in options['write'].items():
-        if item[1].lower() == 'text':                   # Convert to text
+        if item[1].lower() == 'ndjson':                 # NDJSON streams directly from the database
+            writeNdjson(item[0], options)
+            continue
+        elif item[1].lower() == 'text':                 # Convert to text
             output = buildText(data, options)
         elif item[1].lower() == 'html':                 # Convert to HTML
             output = buildHTML(data, options)
@@ -513,8 +799,47 @@ def writeFiles(data, options):
             json.dump(output, outfile)
         outfile.close()
 
+# Write the current run to a newline-delimited JSON (NDJSON) file, one JSON object per entry, tagged with the run_id, host, and action.
+# Rows are streamed straight from the database cursor, so memory use stays the same no matter how large the run is.
+# If the file name ends in '.gz' the output is gzip-compressed.
+# Like the JSON output, this contains all entries ('a', 'r', and 's') minus the ignored signers and companies.
+def writeNdjson(fname, options):
+    import json
+
+    progLog.logWrite("Writing output {} to ndjson file.".format(fname))
+    fspec = '{}\\{}'.format(options['datapath'], fname)
+    if fname.lower().endswith('.gz'):
+        import gzip
+        outfile = gzip.open(fspec, 'wt', encoding='utf-8')
+    else:
+        outfile = open(fspec, 'w', encoding='utf-8')
+
+    curs = db.execSqlStmt("SELECT * FROM {} WHERE run_id='{}'".format(db.historyTable(options['run_id']), options['run_id']))
+    dbFlds = [description[0] for description in curs.description]     # get field names
+    signerIndex = dbFlds.index('signer')
+    companyIndex = dbFlds.index('company')
+
+    rowCount = 0
+    for resultRow in curs:
+        if resultRow[signerIndex] in options['ignore_signer'] or resultRow[companyIndex] in options['ignore_company']:
+            continue
+        entry = dict(zip(dbFlds, resultRow))
+        outfile.write(json.dumps(entry) + '\n')
+        rowCount += 1
+    outfile.close()
+    progLog.logWrite("Wrote {} entries to {}.".format(rowCount, fname))
+    return None
+
 # Send the report out via email
 def sendEmail(data, options, inifile):
+    import smtplib
+    import ssl
+    import email.utils
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
+
     progLog.logWrite("Sending email")
     try:
         serverconnect = smtplib.SMTP(options['email']['server'],options['email']['port'])
@@ -565,6 +890,9 @@ def sendEmail(data, options, inifile):
 # Fields are prer-selected here, not based on the [fields] section of the .ini file
 # See the documentation for an approproate GROK pattern to use with your syslog or SIEM system.
 def sendSyslog(data, options):
+    import logging
+    from logging.handlers import SysLogHandler
+
     progLog.logWrite("Sending log to syslog server: [{}:{}]".format(options['syslog']['server'], options['syslog']['port']))
     try:
         logger = logging.getLogger()
@@ -597,32 +925,407 @@ def sendSyslog(data, options):
     return None
 
 # Print the full arcomp run history, including run_ids and dates. Used to find a specific run_id to delete from the database with the -R option
+# In shard mode the run_ids come from the catalog (plus any runs from before shard mode was turned on), so no shards need to be opened
 def printHistory():
     progLog.logWrite("Printing run_id history")
-    curs = db.execSqlStmt("SELECT DISTINCT run_id FROM history ORDER BY run_id ASC")
+    if db.sharding:
+        curs = db.execSqlStmt("SELECT run_id, shard FROM catalog UNION SELECT DISTINCT run_id, NULL FROM main.history ORDER BY run_id ASC")
+    else:
+        curs = db.execSqlStmt("SELECT DISTINCT run_id, NULL FROM history ORDER BY run_id ASC")
     runids = curs.fetchall()
+
+    # A cataloged run is archived if its data isn't in its shard: the shard file is missing, or it was moved away and a new file was started for the same month
+    storedRuns = set()
+    for shard in sorted({row[1] for row in runids if row[1] is not None}):
+        if db.attachShard(shard):
+            storedRuns.update(row[0] for row in db.execSqlStmt('SELECT DISTINCT run_id FROM shard_{}.history'.format(shard)).fetchall())
+            db.detachShards()      # Only one shard attached at a time, so any number of months can be listed
     for i in range(len(runids)):
         id = runids[i][0]
-        print("{}   ({}-{}-{}  {}:{}:{}.{})".format(id, id[0:4], id[4:6], id[6:8], id[9:11], id[11:13], id[13:15], id[16:]))
+        archived = ''
+        if runids[i][1] is not None and id not in storedRuns:
+            archived = '  [archived]'
+        print("{}   ({}-{}-{}  {}:{}:{}.{}){}".format(id, id[0:4], id[4:6], id[6:8], id[9:11], id[11:13], id[13:15], id[16:], archived))
     return
 
 def deleteRunID(runid):
     progLog.logWrite("Deleting run_id: [{}]".format(runid))
-    curs = db.execSqlStmt("SELECT run_id FROM history WHERE run_id = '{}'".format(runid))
+    histTable = db.historyTable(runid)      # Find (and attach) the run's shard before starting the write transaction
+    db.dbBeginWrite()
+
+    if histTable is None:       # Run is in an archived shard. Just remove it from the catalog.
+        progLog.logWrite("run_id [{}] is in an archived shard. Removing from catalog.".format(runid))
+        curs = db.execSqlStmt("DELETE FROM catalog WHERE run_id = '{}'".format(runid))
+        return None
+
+    curs = db.execSqlStmt("SELECT run_id FROM {} WHERE run_id = '{}'".format(histTable, runid))
     result = curs.fetchall()
     if len(result) == 0:
+        if db.sharding and db.execSqlStmt("DELETE FROM catalog WHERE run_id = '{}'".format(runid)).rowcount > 0:    # Catalog entry left behind with no data
+            progLog.logWrite("run_id [{}] has no data. Removed from catalog.".format(runid))
+            return None
         print("No such run_id: {}".format(runid))
         return None
 
-    curs = db.execSqlStmt("DELETE FROM history WHERE run_id = '{}'".format(runid))
+    curs = db.execSqlStmt("DELETE FROM {} WHERE run_id = '{}'".format(histTable, runid))
     result = curs.fetchall()
+    if db.sharding:
+        curs = db.execSqlStmt("DELETE FROM catalog WHERE run_id = '{}'".format(runid))
     return None
 
 def getRunIdCount(runid):
-    curs = db.execSqlStmt("SELECT COUNT(*) FROM history WHERE run_id='{}'".format(runid))
+    curs = db.execSqlStmt("SELECT COUNT(*) FROM {} WHERE run_id='{}'".format(db.historyTable(runid), runid))
     count = curs.fetchone()[0]
     return count
 
+# HTTP ingest server (-l option)
+# Lets endpoints push their Autoruns .csv exports to arcomp instead of copying files to the analysis machine.
+#   POST /upload?host=<hostname>   Body is the .csv file, optionally gzip-compressed ('Content-Encoding: gzip').
+#                                  The host can also be given in an 'X-Arcomp-Host' header.
+#                                  The response is a JSON summary of what was added and removed since that host's last run.
+#   GET /status                    JSON queue and processing counters
+# Uploads are queued and parsed by a fixed pool of worker threads. A single database thread then loads, compares,
+#   and commits the parsed uploads in batches. If the upload queue is full, the server answers 503 (with Retry-After) rather than taking on more work.
+class IngestServer:
+    options = None
+    uploadQueue = None      # Uploads waiting to be parsed
+    writeQueue = None       # Parsed uploads waiting to be written to the database
+    stats = None            # Counters reported by GET /status
+    statsLock = None
+    queuedBytes = 0         # Size of the uploads accepted but not finished yet, as sent by the clients. Guarded by statsLock.
+    lastRunId = ''          # Last run_id handed out. Used to keep run_ids unique when uploads arrive within the same microsecond.
+
+    # Fields from each added/removed entry to include in the upload response (the same fields sent to syslog)
+    summaryFields = ['location', 'entry', 'description', 'signer', 'company', 'imagepath', 'launchstring']
+
+    def __init__(self, options):
+        import threading
+        import queue
+
+        self.options = options
+        self.uploadQueue = queue.Queue(maxsize = options['server']['queuesize'])
+        self.writeQueue = queue.Queue(maxsize = options['server']['queuesize'])
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0, 'batches': 0}
+        self.statsLock = threading.Lock()
+        return None
+
+    def countStat(self, stat):
+        with self.statsLock:
+            self.stats[stat] += 1
+        return None
+
+    # Current counters and queue lengths, for GET /status
+    def status(self):
+        with self.statsLock:
+            result = dict(self.stats)
+            result['queued_bytes'] = self.queuedBytes
+        result['upload_queue'] = self.uploadQueue.qsize()
+        result['write_queue'] = self.writeQueue.qsize()
+        return result
+
+    # Make room for an upload of size bytes, before reading it from the client.
+    # Returns False if the server already holds as many uploads, or as many bytes, as it's allowed to, so the caller can tell the client to retry later.
+    def reserve(self, size):
+        with self.statsLock:
+            if self.uploadQueue.full() or (self.queuedBytes > 0 and self.queuedBytes + size > self.options['server']['queuebytes']):
+                self.stats['rejected'] += 1
+                return False
+            self.queuedBytes += size
+        return True
+
+    def release(self, size):
+        with self.statsLock:
+            self.queuedBytes -= size
+        return None
+
+    # Queue a reserved upload for processing. Returns False if the queue filled up since the upload was reserved.
+    def submit(self, job):
+        import queue
+        try:
+            self.uploadQueue.put_nowait(job)
+        except queue.Full:
+            self.release(job['size'])
+            self.countStat('rejected')
+            return False
+        self.countStat('accepted')
+        return True
+
+    # Set the result of an upload and release the request waiting on it
+    def finishJob(self, job, status, result):
+        job['status'] = status
+        job['result'] = result
+        self.release(job['size'])
+        if status == 200:
+            self.countStat('processed')
+        else:
+            self.countStat('failed')
+        job['done'].set()
+        return None
+
+    # Worker thread: decompress and parse uploads, then pass them to the database thread
+    def parseWorker(self):
+        import csv
+        import io
+        import zlib
+
+        maxUpload = self.options['server']['maxupload']
+        maxColumns = len(self.options['dbfields']) - 4      # The history table's run_id, action, keyword, and hostname fields don't come from the .csv file
+        while True:
+            job = self.uploadQueue.get()
+            if job is None:     # Shutting down
+                return None
+            try:
+                body = job['body']
+                if job['gzip']:
+                    # Limit the uncompressed size as well, so a small upload can't expand to fill memory
+                    decompressor = zlib.decompressobj(wbits = 31)       # 31 = gzip format
+                    body = decompressor.decompress(body, maxUpload + 1)
+                    if len(body) > maxUpload:
+                        raise ValueError('upload is larger than {} bytes uncompressed'.format(maxUpload))
+                    if not decompressor.eof:
+                        raise EOFError('compressed data ended before the end-of-stream marker')
+                if body[:2] in (b'\xff\xfe', b'\xfe\xff'):     # autorunsc can write UTF-16 output
+                    text = body.decode('utf-16')
+                else:
+                    text = body.decode('utf-8-sig')
+                reader = csv.reader(io.StringIO(text))
+                job['rows'] = []
+                for row in reader:
+                    if len(row) == 0 or row[0] == 'Time':      # Skip header and blank lines
+                        continue
+                    if len(row) < 3 or len(row) > maxColumns:
+                        raise ValueError('line {} has {} columns. Expected 3 to {}.'.format(reader.line_num, len(row), maxColumns))
+                    job['rows'].append(row)
+                if len(job['rows']) == 0:
+                    raise ValueError('no Autoruns entries found')
+            except (OSError, EOFError, zlib.error, UnicodeDecodeError, csv.Error, ValueError) as err:
+                progLog.logWrite("Unable to read upload from host [{}]: {}".format(job['hostname'], err))
+                self.finishJob(job, 400, {'error': 'Unable to read upload: {}'.format(err)})
+                continue
+            job['body'] = None                  # Raw upload is no longer needed
+            self.writeQueue.put(job)            # Blocks if the database thread falls behind, which backs up the upload queue
+
+    # Database thread: load, compare, and commit parsed uploads in batches of up to [server] batchsize.
+    # This is the only thread that uses the database connection.
+    def dbWorker(self):
+        import queue
+        global db
+
+        db = openDatabase(self.options)
+        stopping = False
+        while not stopping:
+            job = self.writeQueue.get()
+            if job is None:     # Shutting down
+                break
+            batch = [job]
+            while len(batch) < self.options['server']['batchsize']:
+                try:
+                    job = self.writeQueue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stopping = True
+                    break
+                batch.append(job)
+            self.processBatch(batch)
+        db.dbClose()
+        return None
+
+    # Load and compare a batch of uploads as a single write transaction.
+    # In shard mode, the batch is split into several transactions if its shards won't all fit under SQLite's attached database limit.
+    def processBatch(self, batch):
+        progLog.logWrite("Processing batch of {} upload(s).".format(len(batch)))
+        while len(batch) > 0:
+            jobs = []
+            jobErrors = {}      # Index in jobs -> error message, for uploads that failed
+            try:
+                for job in batch:
+                    # Each job attaches at most two shards: one for its new run and one for its host's last run
+                    if db.sharding and len(jobs) > 0 and len(db.attachedShards) > Database.maxAttached - 2:
+                        break
+                    jobs.append(job)
+                    job['options'] = dict(self.options)     # Each upload is its own run, for its own host
+                    job['options']['hostname'] = job['hostname']
+                    attachRunShards(job['hostname'], self.newRunId())
+
+                # Give each upload its run_id and find its host's last run once the write lock is held.
+                # A host's second upload in a batch is compared against its first.
+                beginRuns([job['options'] for job in jobs], self.newRunId)
+
+                # Each upload gets a savepoint, so one that fails can be undone without failing the rest of the batch
+                for i, job in enumerate(jobs):
+                    jobOptions = job['options']
+                    db.dbSavepoint('upload')
+                    try:
+                        insertAutoRunRows(jobOptions, job['rows'])
+                        compareAutoRunData(jobOptions)
+                        job['result'] = self.runSummary(jobOptions)
+                        db.dbReleaseSavepoint('upload')
+                    except Exception as err:
+                        progLog.logWrite("Upload from host [{}] failed: {}".format(job['hostname'], err))
+                        db.dbRollbackToSavepoint('upload')
+                        jobErrors[i] = str(err)
+                        # Later uploads from the same host compare against this upload's last run instead
+                        for laterJob in jobs[i+1:]:
+                            if laterJob['options']['last_runid'] == jobOptions['run_id']:
+                                laterJob['options']['last_runid'] = jobOptions['last_runid']
+                db.dbCommit()
+            except Exception as err:
+                progLog.logWrite("Batch failed: {}".format(err))
+                db.dbRollback()
+                for i in range(len(jobs)):
+                    jobErrors[i] = str(err)
+            else:
+                self.countStat('batches')
+            db.detachShards()       # Not in the except block: the exception's traceback can hold cursors open, and SQLite can't DETACH a database with open cursors
+
+            for i, job in enumerate(jobs):
+                job['rows'] = None
+                if i in jobErrors:
+                    self.finishJob(job, 500, {'error': 'Unable to process upload: {}'.format(jobErrors[i])})
+                    continue
+                progLog.logWrite("Processed upload from host [{}] as run_id [{}].".format(job['hostname'], job['options']['run_id']))
+                self.finishJob(job, 200, job['result'])
+            batch = batch[len(jobs):]
+        return None
+
+    # Build the response for an upload: counts of added, removed, and unchanged entries, plus the added and removed entries themselves.
+    # Like the reports, the entry lists leave out ignored signers and companies.
+    def runSummary(self, jobOptions):
+        histTable = db.historyTable(jobOptions['run_id'])
+        summary = {'run_id': jobOptions['run_id'], 'hostname': jobOptions['hostname'], 'last_run_id': jobOptions['last_runid'],
+            'added': 0, 'removed': 0, 'same': 0, 'entries': {}}
+
+        curs = db.execSqlStmt("SELECT action, COUNT(*) FROM {} WHERE run_id='{}' GROUP BY action".format(histTable, jobOptions['run_id']))
+        for action, count in curs.fetchall():
+            summary[action.lower()] = count
+
+        for action in ['ADDED', 'REMOVED']:
+            flds, result = generateDictFromSql("SELECT * FROM {} WHERE run_id='{}' and action='{}'".format(histTable, jobOptions['run_id'], action))
+            summary['entries'][action.lower()] = [{fld: values[fld] for fld in self.summaryFields} for values in result.values()]
+        return summary
+
+    # Generate a run_id for an upload. Called only from the database thread.
+    def newRunId(self):
+        from datetime import timedelta
+
+        runId = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        if runId <= self.lastRunId:     # Same microsecond as the last upload. Move past it.
+            runId = (datetime.strptime(self.lastRunId, "%Y%m%d-%H%M%S-%f") + timedelta(microseconds=1)).strftime("%Y%m%d-%H%M%S-%f")
+        self.lastRunId = runId
+        return runId
+
+    # Start the worker threads and serve HTTP requests until interrupted (Ctrl-C)
+    def serve(self, address, port):
+        import threading
+        import http.server
+        import urllib.parse
+        import json
+
+        ingestServer = self
+        serverOpts = self.options['server']
+
+        # Make sure the database can be opened and is set up before accepting uploads
+        setupDb = openDatabase(self.options)
+        self.options['dbfields'] = setupDb.getTableFieldNames('history')
+        setupDb.dbClose()
+
+        class IngestRequestHandler(http.server.BaseHTTPRequestHandler):
+            def sendJson(self, status, data, headers = {}):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body)
+                return None
+
+            # Read and throw away a request body without holding it in memory
+            def discardBody(self, length):
+                while length > 0:
+                    chunk = self.rfile.read(min(length, 65536))
+                    if not chunk:
+                        break
+                    length -= len(chunk)
+                return None
+
+            def do_GET(self):
+                if urllib.parse.urlsplit(self.path).path != '/status':
+                    return self.sendJson(404, {'error': 'Not found'})
+                return self.sendJson(200, ingestServer.status())
+
+            def do_POST(self):
+                url = urllib.parse.urlsplit(self.path)
+                if url.path != '/upload':
+                    return self.sendJson(404, {'error': 'Not found'})
+
+                hostname = urllib.parse.parse_qs(url.query).get('host', [self.headers.get('X-Arcomp-Host', '')])[0]
+                if hostname == '' or len(hostname) > 255 or not all(c.isalnum() or c in '-_.' for c in hostname):
+                    return self.sendJson(400, {'error': 'Missing or invalid host. Use /upload?host=<hostname>'})
+
+                if self.headers.get('Content-Length') is None:
+                    return self.sendJson(411, {'error': 'Content-Length required'})
+                try:
+                    length = int(self.headers.get('Content-Length'))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.close_connection = True        # Can't tell where the body ends, so the connection can't be reused
+                    return self.sendJson(400, {'error': 'Invalid Content-Length'})
+                if length > serverOpts['maxupload']:
+                    self.close_connection = True
+                    return self.sendJson(413, {'error': 'Upload larger than {} bytes'.format(serverOpts['maxupload'])})
+
+                # Make sure there's room for the upload before reading it. The body of a rejected upload is still read (and thrown away),
+                # so the client gets the 503 instead of a reset connection.
+                if not ingestServer.reserve(length):
+                    self.discardBody(length)
+                    return self.sendJson(503, {'error': 'Server busy. Try again later.'}, {'Retry-After': '5'})
+                job = {'hostname': hostname, 'size': length, 'body': None, 'rows': None, 'options': None,
+                    'gzip': self.headers.get('Content-Encoding', '').lower() == 'gzip', 'status': None, 'result': None, 'done': threading.Event()}
+                try:
+                    job['body'] = self.rfile.read(length)
+                except OSError:
+                    ingestServer.release(length)
+                    raise
+                if not ingestServer.submit(job):
+                    return self.sendJson(503, {'error': 'Server busy. Try again later.'}, {'Retry-After': '5'})
+                if not job['done'].wait(serverOpts['timeout']):
+                    return self.sendJson(504, {'error': 'Timed out waiting for upload to be processed'})
+                return self.sendJson(job['status'], job['result'])
+
+            def log_message(self, format, *args):
+                progLog.logWrite('HTTP {} {}'.format(self.address_string(), format % args))
+
+        class IngestHTTPServer(http.server.ThreadingHTTPServer):
+            request_queue_size = 128        # Listen backlog, so bursts of endpoints connecting at once aren't refused
+
+        workers = [threading.Thread(target=self.parseWorker, daemon=True) for i in range(serverOpts['workers'])]
+        dbThread = threading.Thread(target=self.dbWorker, daemon=True)
+        for thread in workers + [dbThread]:
+            thread.start()
+
+        httpd = IngestHTTPServer((address, port), IngestRequestHandler)
+        progLog.logWrite("Ingest server listening on [{}:{}]. Options: [{}]".format(httpd.server_address[0], httpd.server_address[1], serverOpts))
+        print("arcomp ingest server listening on {}:{}. Press Ctrl-C to stop.".format(httpd.server_address[0], httpd.server_address[1]), flush=True)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+        # Stop accepting uploads, then let the workers finish what's already queued
+        progLog.logWrite("Shutting down ingest server.")
+        httpd.server_close()
+        for thread in workers:
+            self.uploadQueue.put(None)
+        for thread in workers:
+            thread.join()
+        self.writeQueue.put(None)
+        dbThread.join()
+        return None
+
 
 ##### Let's Go! #####
 if __name__ == "__main__":
@@ -631,7 +1334,7 @@ if __name__ == "__main__":
     options = {}
     options['progpath'] = os.path.dirname(os.path.realpath(sys.argv[0]))  # Get program home directory
     options['hostname'] = socket.gethostname()
-    options['run_id'] = datetime.now().strftime("%Y%m%d-%H%M%S-%f") # Each run gets its own run identifier. All entries from the same run have the same run_id.
+    options['run_id'] = newRunId()      # Each run gets its own run identifier. All entries from the same run have the same run_id. A new run gets its final run_id when it is saved.
     options['version'] = version
     options['gitSourceUrl'] = gitSourceUrl
     options['copyright'] = copyright
@@ -666,13 +1369,73 @@ if __name__ == "__main__":
     progArgs = processCmdLineArgs()
     options['file'] = progArgs.file
 
+    # Get database options. Concurrency mode lets several arcomp processes share the same database.
+    options['database'] = {}
+    options['database']['concurrency'] = False
+    if iniFile.getIniOption('database','concurrency') is not None:
+        options['database']['concurrency'] = iniFile.getIniOption('database','concurrency').lower() == 'true'
+    options['database']['busytimeout'] = 5.0            # Seconds to wait on a locked database (SQLite default)
+    if iniFile.getIniOption('database','busytimeout') is not None:
+        options['database']['busytimeout'] = float(iniFile.getIniOption('database','busytimeout'))
+    options['database']['busyretries'] = 0              # Number of retries after the busy timeout expires
+    if iniFile.getIniOption('database','busyretries') is not None:
+        options['database']['busyretries'] = int(iniFile.getIniOption('database','busyretries'))
+    options['database']['sharding'] = False             # Store each month's runs in a separate database file
+    if iniFile.getIniOption('database','sharding') is not None:
+        options['database']['sharding'] = iniFile.getIniOption('database','sharding').lower() == 'true'
+    progLog.logWrite("Database options: [{}]".format(options['database']))
+
+    # Fast path: printing history and removing a run_id only need the database. Skip the rest of the setup.
+    if progArgs.runhistory is True:
+        progLog.logWrite("Printing run history.")
+        db = openDatabase(options, readOnly = True)     # Printing history only reads from the database, so it can use a read-only connection.
+        printHistory()
+        db.dbCommit()
+        db.dbClose()
+        exit(0)
+
+    if progArgs.runremove is not None:
+        progLog.logWrite("Removing run_id [{}].".format(progArgs.runremove))
+        try:
+            db = openDatabase(options)
+            deleteRunID(progArgs.runremove)
+            db.dbCommit()
+        except sqlite3.OperationalError as err:
+            dbErrorExit(err)
+        db.dbClose()
+        exit(0)
+
+    # Run the HTTP ingest server? Format is <address>[:port]
+    if progArgs.listen is not None:
+        options['server'] = {}
+        listenspec = progArgs.listen.split(':')
+        options['server']['address'] = listenspec[0]
+        options['server']['port'] = 8514                # Ingest server default port
+        if len(listenspec) == 2:                        # Port specified
+            options['server']['port'] = int(listenspec[1])
+        options['server']['workers'] = 4                # Number of threads parsing uploads
+        options['server']['queuesize'] = 100            # Uploads that can be waiting before the server answers 'busy'
+        options['server']['batchsize'] = 16             # Uploads committed to the database in one transaction
+        options['server']['maxupload'] = 50000000       # Largest upload accepted, in bytes
+        options['server']['queuebytes'] = 500000000     # Total size of the uploads waiting to be processed, in bytes
+        options['server']['timeout'] = 300              # Seconds an upload request waits to be processed
+        for opt in ['workers', 'queuesize', 'batchsize', 'maxupload', 'queuebytes', 'timeout']:
+            if iniFile.getIniOption('server', opt) is not None:
+                options['server'][opt] = int(iniFile.getIniOption('server', opt))
+
+        progLog.enableThreading()
+        IngestServer(options).serve(options['server']['address'], options['server']['port'])
+        progLog.logWrite("Closing program.")
+        progLog.logClose()
+        exit(0)
+
     if progArgs.write is not None:      # output files specified on the command line
         options['write'] = {}           # Dictionary of output files to write to
         for i in range(len(progArgs.write)):
             fname,type = progArgs.write[i].split(",")
-            if type.lower() not in ['text','html','csv','json']:
-                progLog.logWrite("Command line error, -w option. Invalid type: {}. Filetype must be 'text', 'html', 'csv', or 'json'".format(type))
-                oops("Command line error, -w option. Invalid type: {}. Filetype must be 'text', 'html', 'csv', or 'json'".format(type))
+            if type.lower() not in ['text','html','csv','json','ndjson']:
+                progLog.logWrite("Command line error, -w option. Invalid type: {}. Filetype must be 'text', 'html', 'csv', 'json', or 'ndjson'".format(type))
+                oops("Command line error, -w option. Invalid type: {}. Filetype must be 'text', 'html', 'csv', 'json', or 'ndjson'".format(type))
             options['write'][fname] = type.lower()
     
     if progArgs.syslog is not None:     # Output to syslog is specified. Format is <server>[:port]
@@ -699,28 +1462,11 @@ if __name__ == "__main__":
     options['email']['password'] = None                 # Do not store password until it's necessary to send email
 
     # Open and prep database
-    db = Database(options['datapath'] + '\\arcompdata.db')
-    db.dbSetup()
+    try:
+        db = openDatabase(options)
+    except sqlite3.OperationalError as err:
+        dbErrorExit(err)
     options['dbfields'] = db.getTableFieldNames('history')      # Get names of the fields in the history table. This will come in handy later.
-    
-    # Need to just print history?
-    if progArgs.runhistory is True:
-        progLog.logWrite("Printing run history.")
-        printHistory()
-        db.dbCommit()
-        db.dbClose()
-        exit(0)
-
-    # Need to delete a run_id?
-    if progArgs.runremove is not None:
-        progLog.logWrite("Removing run_id [{}].".format(progArgs.runremove))
-        deleteRunID(progArgs.runremove)
-        db.dbCommit()
-        db.dbClose()
-        exit(0)
-
-    # Get last run_id. This will be used to compare against the current run_id.
-    options['last_runid'] = getLastRunId()
 
     # Are we processing a command-line file or letting autorunsc.exe do its thing?
     if options['file'] is None:                 # There's no specific file to process. Execute autorunsc.exe and collect output file
@@ -729,14 +1475,32 @@ if __name__ == "__main__":
         result = os.system(cmdline)
         options['file'] = '{}\\aroutput.csv'.format(options['datapath'])
 
-    # Load data from file
-    loadAutoRunData(options)
-
-    # Compare current run to last run and add results to database
-    compareAutoRunData(options)
+    try:
+        # Load, compare and tag the new run as a single write transaction.
+        # The run_id and last run_id (used to compare against the current run) are set once the write lock is held, so overlapping runs are compared in the order they're saved.
+        attachRunShards(options['hostname'], options['run_id'])
+        beginRuns([options], newRunId)
+        progLog.logWrite("Saving run as run_id [{}].".format(options['run_id']))
+
+        # Load data from file
+        loadAutoRunData(options)
+
+        # Compare current run to last run and add results to database
+        compareAutoRunData(options)
+
+        # In concurrency mode, release the write lock now and generate reports from a read-only connection
+        if options['database']['concurrency']:
+            db.dbCommit()
+            db.dbClose()
+            db = openDatabase(options, readOnly = True)
+    except sqlite3.OperationalError as err:
+        dbErrorExit(err)
 
     # Generate report based on database results
-    reportData = generateReport(options)
+    # NDJSON output streams from the database on its own, so skip building the full report in memory if nothing else needs it
+    reportData = None
+    if options['email']['send'] is True or progArgs.syslog is not None or ('write' in options and any(t != 'ndjson' for t in options['write'].values())):
+        reportData = generateReport(options)
 
     # Do we need to send output to files?
     if 'write' in options:
@@ -752,6 +1516,9 @@ if __name__ == "__main__":
 
     # Close database and exit
     progLog.logWrite("Closing program.")
-    db.dbCommit()
+    try:
+        db.dbCommit()
+    except sqlite3.OperationalError as err:
+        dbErrorExit(err)
     db.dbClose()
 
@@ -0,0 +1,123 @@
+######
+#
+# Program name: arcpush.py
+# Purpose:      Upload Autoruns .csv files to an arcomp ingest server (arcomp.py -l)
+#               Can also simulate many endpoints uploading at once, to test an ingest server before rolling it out
+# Author:       Stephen Fried for Handy Guy Software
+#
+#####
+
+# Import system modules
+import argparse
+import csv
+import gzip
+import io
+import json
+import socket
+import statistics
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Column headings produced by 'autorunsc.exe -a * -c -h -s -v -vt'
+autorunsHeader = ['Time','Entry Location','Entry','Enabled','Category','Profile','Description','Signer','Company','Image Path','Version','Launch String',
+    'VT detection','VT permalink','MD5','SHA-1','PESHA-1','PESHA-256','SHA-256','IMP']
+
+# Process command line arguments
+def processCmdLineArgs():
+    argParser = argparse.ArgumentParser(description='Upload Autoruns files to an arcomp ingest server.')
+    argParser.add_argument("-u","--url", help="Ingest server address. Default is 'http://127.0.0.1:8514'", default='http://127.0.0.1:8514', action="store")
+    argParser.add_argument("-f","--file", help="Autoruns .csv file to upload. Must be created using 'autorunsc.exe -a * -c -h -s -v -vt -o <filename>'", action="store")
+    argParser.add_argument("-n","--hostname", help="Host name to tag the upload with. Default is this computer's name.", default=socket.gethostname(), action="store")
+    argParser.add_argument("-z","--gzip", help="Compress uploads with gzip.", action="store_true")
+    argParser.add_argument("-S","--simulate", type=int, help="Simulate <simulate> endpoints uploading generated Autoruns data at the same time.", action="store")
+    argParser.add_argument("-e","--entries", type=int, default=200, help="Number of Autoruns entries per simulated endpoint. Default is 200.")
+    argParser.add_argument("-r","--rounds", type=int, default=2, help="Number of uploads per simulated endpoint. Each round adds one entry and removes one entry. Default is 2.")
+    args = argParser.parse_args()
+    if args.file is None and args.simulate is None:
+        argParser.error("either -f or -S is required")
+    return args
+
+# Upload one Autoruns file. Retries while the server is busy (503).
+# Returns (HTTP status, response data, number of busy retries, seconds taken)
+def upload(url, hostname, data, compress):
+    headers = {'Content-Type': 'text/csv'}
+    if compress:
+        data = gzip.compress(data)
+        headers['Content-Encoding'] = 'gzip'
+
+    uploadUrl = '{}/upload?host={}'.format(url.rstrip('/'), urllib.parse.quote(hostname))
+    retries = 0
+    start = time.perf_counter()
+    while True:
+        request = urllib.request.Request(uploadUrl, data=data, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                return response.status, json.loads(response.read()), retries, time.perf_counter() - start
+        except urllib.error.HTTPError as err:
+            if err.code != 503:
+                return err.code, json.loads(err.read() or b'{}'), retries, time.perf_counter() - start
+            retries += 1
+            time.sleep(float(err.headers.get('Retry-After', '1')))
+        except (urllib.error.URLError, ConnectionError) as err:
+            return None, {'error': str(err)}, retries, time.perf_counter() - start
+
+# Generate Autoruns .csv data for a simulated endpoint.
+# Each round shifts the window of entries by one, so every round after the first adds one entry and removes one.
+def simulatedData(hostname, entries, round):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(autorunsHeader)
+    for i in range(round, round + entries):
+        writer.writerow(['20220101-000000', 'HKLM\\SOFTWARE\\Microsoft\\Windows\\CurrentVersion\\Run', 'entry{}'.format(i), 'enabled', 'Logon', 'System-wide',
+            'Simulated entry {} on {}'.format(i, hostname), '(Verified) Simulated Signer', 'Simulated Company', 'c:\\sim\\entry{}.exe'.format(i), '1.0.0.{}'.format(i),
+            'c:\\sim\\entry{}.exe /start'.format(i), '', '', '', '', '', '', '', ''])
+    return output.getvalue().encode('utf-8')
+
+# Simulate one endpoint: upload each round in turn and check the server's summary against what changed
+# Returns a list of (status, busy retries, seconds, error message) for each upload
+def simulateEndpoint(url, hostname, entries, rounds, compress):
+    results = []
+    for round in range(rounds):
+        status, summary, retries, elapsed = upload(url, hostname, simulatedData(hostname, entries, round), compress)
+        error = None
+        if status != 200:
+            error = 'HTTP {}: {}'.format(status, summary.get('error'))
+        else:
+            expected = {'added': entries, 'removed': 0, 'same': 0} if round == 0 else {'added': 1, 'removed': 1, 'same': entries - 1}
+            actual = {key: summary[key] for key in expected}
+            if actual != expected:
+                error = 'round {} summary {} expected {}'.format(round, actual, expected)
+        results.append((status, retries, elapsed, error))
+    return results
+
+##### Let's Go! #####
+if __name__ == "__main__":
+    progArgs = processCmdLineArgs()
+
+    # Upload a single file
+    if progArgs.simulate is None:
+        with open(progArgs.file, 'rb') as f:
+            status, summary, retries, elapsed = upload(progArgs.url, progArgs.hostname, f.read(), progArgs.gzip)
+        print(json.dumps(summary, indent=2))
+        exit(0 if status == 200 else 1)
+
+    # Simulate many endpoints uploading at once. Host names are unique per simulation run so each starts with no history.
+    simId = time.strftime('%Y%m%d%H%M%S')
+    hostnames = ['sim-{}-{:04d}'.format(simId, i) for i in range(progArgs.simulate)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=progArgs.simulate) as executor:
+        futures = [executor.submit(simulateEndpoint, progArgs.url, hostname, progArgs.entries, progArgs.rounds, progArgs.gzip) for hostname in hostnames]
+        results = [result for future in futures for result in future.result()]
+    totalTime = time.perf_counter() - start
+
+    errors = [result[3] for result in results if result[3] is not None]
+    latencies = sorted(result[2] for result in results)
+    print('Endpoints: {}  Uploads: {}  Failed: {}  Busy retries: {}'.format(progArgs.simulate, len(results), len(errors), sum(result[1] for result in results)))
+    print('Total time: {:.1f}s  Uploads/sec: {:.1f}'.format(totalTime, len(results) / totalTime))
+    print('Latency (s): median {:.2f}  95th percentile {:.2f}  max {:.2f}'.format(statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1 if len(latencies) > 1 else 0], latencies[-1]))
+    for error in errors[:10]:
+        print('  {}'.format(error))
+    exit(0 if len(errors) == 0 else 1)